@@ -10,7 +10,7 @@ User profile https://stackoverflow.com/users/3769451/apadana
 
 Modified by github.com/awwad to add support for replies (threads).
 
-This is Python2-compatible and not Python3-compatible.
+This requires Python 3.
 
 """
 import httplib2
@@ -18,18 +18,90 @@ import os
 import oauth2client
 from oauth2client import client, tools
 import base64
+import json
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from apiclient import errors, discovery
+from googleapiclient import errors, discovery
 import mimetypes
+import mmap
+import random
+import time
+import threading
 from email.mime.image import MIMEImage
 from email.mime.audio import MIMEAudio
 from email.mime.base import MIMEBase
+from email import encoders
 
 SCOPES = 'https://www.googleapis.com/auth/gmail.send'
 CLIENT_SECRET_FILE = 'client_secret.json'
 APPLICATION_NAME = 'Gmail API Python Send Email'
 
+# Directory in which httplib2 caches HTTP responses, so that the Gmail API
+# discovery document need not be fetched again on every run.
+HTTP_CACHE_DIR = '.http_cache'
+
+# Number of times a message that Gmail failed to send because of rate
+# limiting or a server error (see RETRYABLE_STATUSES) is retried, with
+# exponential backoff. The already-built message body is resent as is.
+SEND_RETRIES = 5
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+# Reasons given by Gmail for a 403 response that mean the request was rate
+# limited, and so is worth retrying (as googleapiclient does for requests
+# executed singly).
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+
+# Maximum rate, in messages per second, at which messages are submitted to
+# Gmail. Gmail allows each user 250 quota units per second (as a moving
+# average, so short bursts are fine), and sending a message costs 100 units.
+MAX_SENDS_PER_SECOND = 2.5
+
+# Number of messages that may be submitted at once, after a pause: a burst of
+# a couple of seconds' worth of quota. This is also the number of messages in
+# each batch request (see batch_send()), as a larger batch would exceed the
+# quota the moment it was submitted. (The Gmail API itself accepts up to 100
+# requests in a batch request.)
+MAX_SEND_BURST = 5
+
+# Gmail API service, built on first use by _get_service() and reused after.
+_SERVICE = None
+
+class RateLimiter(object):
+    """Token bucket limiting the rate of some operation across threads.
+
+    Args:
+      rate: The number of operations allowed per second, on average.
+      burst: The number of operations allowed at once after a quiet period.
+    """
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, count=1):
+        """Wait until count more operations are allowed, then claim them.
+
+        count may exceed burst: the tokens are claimed at once, and the wait
+        lasts until the bucket would have refilled enough to cover them.
+        Callers that come later wait their turn after that.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self._burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= count
+            delay = -self._tokens / self._rate
+        # Sleep outside the lock; the tokens are already claimed.
+        if delay > 0:
+            time.sleep(delay)
+
+# Paces all messages sent, whether singly or in batches.
+_SEND_LIMITER = RateLimiter(MAX_SENDS_PER_SECOND, MAX_SEND_BURST)
+
 def get_credentials():
     home_dir = os.path.expanduser('~')
     credential_dir = os.path.join(home_dir, '.credentials')
@@ -43,34 +115,198 @@ def get_credentials():
         flow = client.flow_from_clientsecrets(CLIENT_SECRET_FILE, SCOPES)
         flow.user_agent = APPLICATION_NAME
         credentials = tools.run_flow(flow, store)
-        print 'Storing credentials to ' + credential_path
+        print('Storing credentials to ' + credential_path)
     return credentials
 
-def SendMessage(
+def _get_service():
+    global _SERVICE
+    if _SERVICE is None:
+        credentials = get_credentials()
+        http = credentials.authorize(httplib2.Http(cache=HTTP_CACHE_DIR))
+        _SERVICE = discovery.build('gmail', 'v1', http=http)
+    return _SERVICE
+
+def build_message(
     sender, to, subject, msgHtml, msgPlain, attachmentFile=None,
     threadId=None, reply_to=None):
-    credentials = get_credentials()
-    http = credentials.authorize(httplib2.Http())
-    service = discovery.build('gmail', 'v1', http=http)
+    """Create the message body to send, without sending it.
+
+    Returns:
+      An object containing a base64url encoded email object, as accepted by
+      SendMessageInternal and batch_send.
+    """
     if attachmentFile:
-        message1 = createMessageWithAttachment(
-            sender, to, subject, msgHtml, msgPlain, attachmentFile, threadId)
+        return createMessageWithAttachment(
+            sender, to, subject, msgHtml, msgPlain, attachmentFile, threadId,
+            reply_to)
     else:
-        message1 = CreateMessageHtml(
-            sender, to, subject, msgHtml, msgPlain, threadId)
+        return CreateMessageHtml(
+            sender, to, subject, msgHtml, msgPlain, threadId, reply_to)
+
+def SendMessage(
+    sender, to, subject, msgHtml, msgPlain, attachmentFile=None,
+    threadId=None, reply_to=None):
+    service = _get_service()
+    message1 = build_message(
+        sender, to, subject, msgHtml, msgPlain, attachmentFile, threadId)
     result = SendMessageInternal(service, "me", message1)
     return result
 
+def batch_send(messages, build=None):
+    """Send several messages, MAX_SEND_BURST at a time per HTTP request.
+
+    The batch requests are submitted one after another, each waiting for
+    enough of the send quota (see MAX_SENDS_PER_SECOND) to cover it.
+    Messages that fail with a status in RETRYABLE_STATUSES are resent in a
+    further batch after an exponentially growing delay, up to SEND_RETRIES
+    times.
+
+    Args:
+      messages: A list of message bodies, as returned by build_message. Or,
+        if build is given, a list of items from each of which build makes a
+        message body.
+      build: Optional function making a message body from an item of
+        messages. Each body is then only made as its batch request is about
+        to be submitted, and kept only until it is sent (or given up on), so
+        that the bodies of all the messages are never in memory at once. If
+        making a message body raises an exception, that message is
+        reported as "Error" and the rest are still sent.
+
+    Returns:
+      A list with one entry per message, in the same order: the sent message
+      resource, or "Error" if that message could not be sent. Failures are
+      reported here rather than raised, so that the caller always learns
+      which messages were sent.
+    """
+    results = [None] * len(messages)
+    to_retry = set()
+
+    # Message bodies that have been made but not yet sent or given up on.
+    bodies = {}
+
+    def get_body(index):
+        # Returns the body of messages[index], or None if it cannot be made.
+        if build is None:
+            return messages[index]
+        if index not in bodies:
+            try:
+                bodies[index] = build(messages[index])
+            except Exception as error:
+                print('Unable to build message %d: %s' % (index, error))
+                results[index] = "Error"
+                return None
+        return bodies[index]
+
+    def callback(request_id, response, exception):
+        index = int(request_id)
+        if results[index] is not None or index in to_retry:
+            return # Already reported, before the batch request failed.
+        if exception is None:
+            print('Message Id: %s' % response['id'])
+            results[index] = response
+        elif _is_retryable(exception):
+            to_retry.add(index)
+            return # The body is kept, to be resent as is.
+        else:
+            print('An error occurred: %s' % exception)
+            results[index] = "Error"
+        bodies.pop(index, None)
+
+    pending = range(len(messages))
+    for retry in range(SEND_RETRIES + 1):
+        if retry:
+            delay = 2 ** (retry - 1) + random.random()
+            print('Retrying %d messages in %.1fs' % (len(pending), delay))
+            time.sleep(delay)
+        _execute_batches(get_body, pending, callback)
+        pending = sorted(to_retry)
+        to_retry.clear()
+        if not pending:
+            break
+
+    for index in pending:
+        print('Giving up on message %d after %d retries' % (
+            index, SEND_RETRIES))
+        results[index] = "Error"
+
+    return results
+
+def _execute_batches(get_body, indices, callback):
+    # Sends the message with body get_body(index) for each index in indices,
+    # reporting each result to callback with the index as the request ID.
+    # Messages whose body is None (could not be made) are skipped.
+    service = _get_service()
+
+    for start in range(0, len(indices), MAX_SEND_BURST):
+        batch = service.new_batch_http_request(callback=callback)
+        batch_indices = []
+        for index in indices[start:start + MAX_SEND_BURST]:
+            body = get_body(index)
+            if body is None:
+                continue
+            batch.add(
+                service.users().messages().send(userId='me', body=body),
+                request_id=str(index))
+            batch_indices.append(index)
+        if not batch_indices:
+            continue
+        _SEND_LIMITER.acquire(len(batch_indices))
+        try:
+            batch.execute()
+        except (errors.HttpError, OSError, httplib2.HttpLib2Error) as error:
+            # The batch request as a whole failed (e.g. it was rate limited,
+            # or the connection dropped), so each of its messages is reported
+            # as having failed with that error, and retried if it may be.
+            for index in batch_indices:
+                callback(str(index), None, error)
+
+def _is_retryable(error):
+    # Whether a request that failed with the given exception is worth
+    # retrying, by the same rules googleapiclient applies to requests executed
+    # singly: rate limiting, server errors and transport failures.
+    if isinstance(error, errors.HttpError):
+        if error.resp.status in RETRYABLE_STATUSES:
+            return True
+        return error.resp.status == 403 and \
+            _get_error_reason(error) in RATE_LIMIT_REASONS
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+def _get_error_reason(error):
+    # The reason given in the body of an HttpError, e.g.
+    # 'userRateLimitExceeded', or None if there is none.
+    try:
+        content = json.loads(error.content.decode('utf-8'))
+        return content['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return None
+
 def SendMessageInternal(service, user_id, message):
     try:
-        message = (service.users().messages().send(userId=user_id, body=message).execute())
-        print 'Message Id: %s' % message['id']
+        _SEND_LIMITER.acquire()
+        # execute() itself retries with exponential backoff on rate limiting
+        # and server errors, resending the same request body.
+        message = (service.users().messages().send(userId=user_id, body=message)
+                   .execute(num_retries=SEND_RETRIES))
+        print('Message Id: %s' % message['id'])
         return message
-    except errors.HttpError, error:
-        print 'An error occurred: %s' % error
+    except errors.HttpError as error:
+        print('An error occurred: %s' % error)
         return "Error"
     return "OK"
 
+def _encode_message(message, thread_id=None):
+    """Return the Gmail API message body for the given MIME message.
+
+    The message is serialized once, straight to the bytes that are base64url
+    encoded (as_bytes() rather than as_string(), which would produce a str
+    that then had to be encoded again).
+    """
+    body = {
+        'raw': base64.urlsafe_b64encode(message.as_bytes()).decode('ascii')}
+    if thread_id is not None:
+        body['threadId'] = thread_id
+    return body
+
 def CreateMessageHtml(
     sender, to, subject, msgHtml, msgPlain, thread_id=None, reply_to=None):
     msg = MIMEMultipart('alternative')
@@ -82,11 +318,7 @@ def CreateMessageHtml(
     msg.attach(MIMEText(msgPlain, 'plain'))
     msg.attach(MIMEText(msgHtml, 'html'))
 
-    if thread_id is not None:
-      return {'raw': base64.urlsafe_b64encode(msg.as_string()),
-          'threadId': thread_id}
-
-    return {'raw': base64.urlsafe_b64encode(msg.as_string())}
+    return _encode_message(msg, thread_id)
 
 def createMessageWithAttachment(
     sender, to, subject, msgHtml, msgPlain, attachmentFile,
@@ -120,38 +352,44 @@ def createMessageWithAttachment(
 
     message.attach(messageA)
 
-    print "create_message_with_attachment: file:", attachmentFile
+    print("create_message_with_attachment: file:", attachmentFile)
     content_type, encoding = mimetypes.guess_type(attachmentFile)
 
     if content_type is None or encoding is not None:
         content_type = 'application/octet-stream'
     main_type, sub_type = content_type.split('/', 1)
     if main_type == 'text':
-        fp = open(attachmentFile, 'rb')
-        msg = MIMEText(fp.read(), _subtype=sub_type)
-        fp.close()
-    elif main_type == 'image':
-        fp = open(attachmentFile, 'rb')
-        msg = MIMEImage(fp.read(), _subtype=sub_type)
-        fp.close()
-    elif main_type == 'audio':
-        fp = open(attachmentFile, 'rb')
-        msg = MIMEAudio(fp.read(), _subtype=sub_type)
-        fp.close()
+        # MIMEText takes a str. Undecodable bytes are replaced rather than
+        # failing the whole message.
+        with open(attachmentFile, 'rb') as fp:
+            text = fp.read().decode('utf-8', 'replace')
+        msg = MIMEText(text, _subtype=sub_type)
     else:
-        fp = open(attachmentFile, 'rb')
-        msg = MIMEBase(main_type, sub_type)
-        msg.set_payload(fp.read())
-        fp.close()
+        # Other attachments are base64-encoded as the MIME part is created.
+        # Mapping the file into memory lets the encoder read it from the page
+        # cache instead of from a complete copy of the file in a string.
+        with open(attachmentFile, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = b'' # An empty file cannot be mapped.
+            try:
+                if main_type == 'image':
+                    msg = MIMEImage(data, _subtype=sub_type)
+                elif main_type == 'audio':
+                    msg = MIMEAudio(data, _subtype=sub_type)
+                else:
+                    msg = MIMEBase(main_type, sub_type)
+                    msg.set_payload(data)
+                    encoders.encode_base64(msg)
+            finally:
+                if data:
+                    data.close()
     filename = os.path.basename(attachmentFile)
     msg.add_header('Content-Disposition', 'attachment', filename=filename)
     message.attach(msg)
 
-    if threadId is not None:
-        return {'raw': base64.urlsafe_b64encode(message.as_string()),
-            'threadId': threadId}
-
-    return {'raw': base64.urlsafe_b64encode(message.as_string())}
+    return _encode_message(message, threadId)
 
 
 def main():
@@ -19,10 +19,13 @@
   Running this module directly results in the following:
 
    - Saves data from the Discourse Database into some JSON files:
-     topics.json, posts.json, users.json, processed_post_data.json
+     topics.json (including posts), users.json, processed_post_data.json
+     (When a topic ID or 'all' is given, only if --dump is also given.)
 
    - If given a topic ID as a command-line argument, also emails that topic's
-     digest in to the forum.
+     digest in to the forum. Only that topic is retrieved from the database,
+     unless --dump is also given (the JSON files always cover the whole
+     forum).
 
    - If given the command-line argument 'all', emails all topic digests
      in to the forum.
@@ -32,162 +35,440 @@
   Prerequisites for this module's full operation:
    - pip install google-api-python-client
    - pip install psycopg2
+   - pip install orjson
    - Create a Gmail API credential for a new project
      https://console.developers.google.com/start/api?id=gmail
      and download the client_id.json file. Renamed it to client_secret.json and
      put it in the working directory from which this script is to be run.
-   - Run only using Python2.
+   - Run using Python 3.10 or later.
+   - PostgreSQL 9.4 or later.
 
 
 """
+import argparse
+import contextlib
 import psycopg2
-import json
-import datetime
+import psycopg2.extras
+import psycopg2.pool
+import orjson
+import dataclasses
+import functools
 import gmailer
 import time
+import threading
 import os.path
-
-# Column enumeration in the Topics, Posts, and Users tables in the
-# Discourse database.
-# Ensure that the columns are correct for your Discourse version and
-# configuration.
-
-P_PID = 0     # index of post ID column in posts table
-P_UID = 1     # index of user ID column in posts table
-P_TID = 2     # index of topic ID column in posts table
-P_CREATED = 6 # index of created date column in posts table
-P_UPDATED = 7 # index of updated date column in posts table
-P_RAW = 4     # index of plaintext post contents column in posts table
-P_COOKED = 5  # index of "cooked" html post contents column in posts table
-P_IMGURL = 50 # index of attached image URL column in posts table
-
-T_TID = 0   # index of topic ID column in topics table
-T_UID = 7   # index of user ID column in topics table
-T_TITLE = 1 # index of title column in topics table
-T_CREATED = 3 # index of created date column in topics table
-
-U_UID = 0   # index of user ID column in users table
-U_UNAME = 1 # index of username column in users table
-U_NAME = 2  # index of full name column in users table
-U_EMAIL = 5 # index of email address column in users table
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 BACKUP_MAILER = None # Replace with emailing acount's email address.
 FORUM_ADDRESS = None # replace with Google Group's email address.
 
 DBNAME = None # replace with the name of the Discourse database
 
+# Maximum number of simultaneous connections to the Discourse database.
+MAX_DB_CONNECTIONS = 8
+
+# Pool of connections to the Discourse database, created on first use by
+# _get_connection() and reused after.
+_CONNECTION_POOL = None
+
+# Guards the creation of _CONNECTION_POOL, as users and topics may be
+# harvested from different threads (see main()).
+_CONNECTION_POOL_LOCK = threading.Lock()
+
+# SQL expression giving the author string for a row of the users table, e.g.
+# 'alice (Alice Bob alice@bob.not)'.
+SQL_AUTHOR = (
+    "users.username || ' (' || COALESCE(users.name, '') || ' ' || "
+    "users.email || ')'")
+
+# Number of topics (each with all of its posts) fetched from the database at a
+# time while streaming topics.
+TOPICS_FETCH_SIZE = 200
+
+# Number of users fetched from the database at a time while streaming users.
+USERS_FETCH_SIZE = 10000
+
 SLEEP_DURATION_BETWEEN_MAILINGS = 0.2
 SLEEP_DURATION_BETWEEN_TOPIC_ROUNDS = 10
 
+# The JSON output files are written compactly (orjson's default), as they are
+# not meant to be read by people. They are written one row or topic at a time;
+# a large buffer turns these writes into few system calls.
+OUTPUT_BUFFER_SIZE = 1 << 20 # 1 MiB
+
+# Details on a post, in the header preceding it in a topic digest (after the
+# separator and post number).
+DIGEST_POST_DETAILS = (
+    'Post Author: %(author)s\n'
+    'Created: %(created)s\n'
+    '%(updated)s'
+    '%(image_url)s'
+    '\n')
+
+# Header preceding a post in the email sent in for it (see
+# construct_post_email_contents()). The topic title is filled in once per
+# topic (see make_topic_header_templates()), which leaves a template for the
+# per-post details.
+POST_EMAIL_HEADER = (
+    'Post %%(post_number)d of Topic "%(title)s"\n'
+    'Post Created: %%(created)s\n'
+    '%%(updated)s'
+    '%%(image_url)s'
+    'Post Author %%(author)s wrote:\n\n')
+
+# Preceding the header of the first post in a topic.
+FIRST_POST_BANNER = (
+    'Topic posted by Discourse-to-Google-Groups forum transfer.\n')
+FIRST_POST_BANNER_HTML = FIRST_POST_BANNER.replace('\n', '<br />')
+
 PATH_TO_UPLOADS_DIR = 'uploads/' # sitting in the working directory
 INTERNAL_UPLOAD_PATH_PREFIX = '<forum_location>/uploads/'
 INTERNAL_UPLOAD_PATH_PREFIX = '/forum/uploads/'
 
 
-def serialize_datetime(obj):
+@dataclasses.dataclass(slots=True)
+class Post:
   """
-  Given a datetime object, returns a string representing it. Given any other
-  object, simply returns that object. This is of use as a default serializer
-  for content containing all JSON-serializable types except for datetimes.
-  It can be passed to json.dump(..., default=serialize_datetime, ...).
+  A post in a topic, as stored in the dictionary generated by
+  generate_single_dict(). Dates are ISO 8601 strings.
   """
-  if isinstance(obj, datetime.datetime):
-    return obj.isoformat()
-  else:
-    return obj
+  author: str
+  created: str
+  updated: str
+  raw: str
+  cooked: str
+  image_url: Optional[str]
 
+  def __post_init__(self):
+    # Each author's string is decoded anew for every post; interning it keeps
+    # a single copy per author, however many posts they wrote.
+    self.author = sys.intern(self.author)
 
 
 
 
-def harvest_from_psql_db():
 
-  # The following line may need to be edited to handle credentials, depending
-  # on local access to the PostgreSQL database.
-  conn = psycopg2.connect("dbname='" + DBNAME + "' host='localhost'")
+def serialize_for_json(obj):
+  """
+  Given a namedtuple (e.g. a row streamed from the database), returns a list
+  of its values. Otherwise, raises TypeError. orjson serializes datetimes and
+  dataclasses (Posts) itself, but not namedtuples, which the json module
+  wrote out as lists.
+  It can be passed to orjson.dumps(..., default=serialize_for_json).
+  """
+  if isinstance(obj, tuple):
+    return list(obj)
 
-  cur = conn.cursor()
+  raise TypeError('Cannot serialize ' + type(obj).__name__ + ' as JSON')
 
-  cur.execute(
-      "SELECT * FROM topics "
-      "WHERE topics.archetype = 'regular' "
-      "AND topics.user_id != -1 "
-      "AND topics.visible IS TRUE "
-      "ORDER BY topics.id")
 
-  topics = cur.fetchall()
 
-  cur.execute(
-      "SELECT posts.* FROM posts "
-      "JOIN topics ON posts.topic_id = topics.id "
-      "WHERE topics.archetype = 'regular' "
+
+
+def _get_connection():
+  """
+  Returns a read-only connection to the Discourse database from the
+  connection pool, creating the pool on first use. Connections should be
+  handed back with _CONNECTION_POOL.putconn() when no longer needed.
+  """
+  global _CONNECTION_POOL
+
+  with _CONNECTION_POOL_LOCK:
+    if _CONNECTION_POOL is None:
+      # The following line may need to be edited to handle credentials,
+      # depending on local access to the PostgreSQL database.
+      _CONNECTION_POOL = psycopg2.pool.ThreadedConnectionPool(
+          1, MAX_DB_CONNECTIONS, "dbname='" + DBNAME + "' host='localhost'")
+
+  conn = _CONNECTION_POOL.getconn()
+
+  # Only SELECTs are run. (autocommit is not used, as the server-side cursor
+  # in stream_topics() can only exist inside a transaction.)
+  conn.set_session(readonly=True)
+
+  return conn
+
+
+
+
+
+def harvest_from_psql_db(tid=None, include_users=True):
+  """
+  Returns a 2-tuple containing:
+   - an iterator over the regular, visible topics, each with its posts (see
+     stream_topics()); only the topic with ID tid, if tid is given
+   - an iterator over all users (see stream_users()), or None if
+     include_users is False
+
+  Neither topics nor users are fetched here; they are streamed from the
+  database as they are consumed.
+  """
+
+  topics = stream_topics(tid)
+
+  if not include_users:
+    return (topics, None)
+
+  return (topics, stream_users())
+
+
+
+
+
+def _stream_rows(name, query, params, fetch_size):
+  """
+  Generator yielding the rows (as namedtuples) resulting from the given query,
+  run with the given parameters through a named (server-side) cursor with the
+  given name, through which rows are retrieved fetch_size at a time. This
+  keeps memory use bounded however large the result is.
+  """
+  conn = _get_connection()
+
+  cur = conn.cursor(name=name, cursor_factory=psycopg2.extras.NamedTupleCursor)
+  cur.itersize = fetch_size
+
+  try:
+    cur.execute(query, params)
+
+    for row in cur:
+      yield row
+
+  finally:
+    # Release the server-side cursor and the connection.
+    cur.close()
+    _CONNECTION_POOL.putconn(conn)
+
+
+
+
+
+def stream_users():
+  """
+  Generator yielding all users, each as a namedtuple, USERS_FETCH_SIZE rows
+  at a time (see _stream_rows()).
+  """
+  return _stream_rows(
+      'users_stream',
+      "SELECT id, username, name, approved, blocked, email FROM users",
+      None, USERS_FETCH_SIZE)
+
+
+
+
+
+def stream_topics(tid=None):
+  """
+  Generator yielding the regular, visible topics in order of topic ID, each
+  as a namedtuple whose posts field is the list of the topic's posts, in
+  order, already in the form used by generate_single_dict(). If tid is given,
+  only the topic with that ID (if it is a regular, visible topic) is yielded.
+
+  Topics and posts are fetched in a single query, with Postgres aggregating
+  each topic's posts (as JSON) and composing the authors. The result can be
+  very large, so rather than fetching it all at once, a named (server-side)
+  cursor is used, through which topics are retrieved TOPICS_FETCH_SIZE rows
+  at a time.
+
+  Requires PostgreSQL 9.4 or later.
+  """
+  # Rows are returned as namedtuples, so columns are accessed by name.
+  # Only the columns used are selected; ensure that the column names are
+  # correct for your Discourse version and configuration.
+  # Each user's author string is composed once, in the authors CTE, rather
+  # than once per topic and post.
+  return _stream_rows(
+      'topics_stream',
+      "WITH authors AS ("
+      "SELECT users.id, " + SQL_AUTHOR + " AS author FROM users) "
+      "SELECT topics.id, topics.title, topics.created_at, "
+      "COALESCE(topic_authors.author, 'UNKNOWN USER') AS author, "
+      "COALESCE("
+      "json_agg(json_build_object("
+      "'author', COALESCE(post_authors.author, 'UNKNOWN USER'), "
+      "'created', posts.created_at, "
+      "'updated', posts.updated_at, "
+      "'raw', posts.raw, "
+      "'cooked', posts.cooked, "
+      "'image_url', posts.image_url) "
+      "ORDER BY posts.post_number) "
+      "FILTER (WHERE posts.id IS NOT NULL), "
+      "'[]') AS posts "
+      "FROM topics "
+      "LEFT JOIN authors AS topic_authors "
+      "ON topic_authors.id = topics.user_id "
+      "LEFT JOIN posts ON posts.topic_id = topics.id "
       "AND posts.user_deleted IS FALSE "
       "AND posts.post_type = 1 "
+      "LEFT JOIN authors AS post_authors ON post_authors.id = posts.user_id "
+      "WHERE topics.archetype = 'regular' "
       "AND topics.user_id != -1 "
-      "AND topics.visible IS TRUE "
-      "ORDER BY posts.topic_id, posts.post_number")
+      "AND topics.visible IS TRUE " +
+      ("AND topics.id = %(tid)s " if tid is not None else "") +
+      "GROUP BY topics.id, topic_authors.author "
+      "ORDER BY topics.id",
+      {'tid': tid}, TOPICS_FETCH_SIZE)
 
-  posts = cur.fetchall()
 
-  print 'Retrieved ' + str(len(topics)) + ' topics ' \
-      'containing ' + str(len(posts)) + ' posts.'
 
-  cur.execute(
-      "SELECT id, username, name, approved, blocked, email FROM users")
 
-  users = cur.fetchall()
 
-  print 'Retrieved ' + str(len(users)) + ' users.'
+def print_to_json(users, stop=None):
+  """
+  Saves the given users (any iterable, e.g. as streamed by stream_users()) to
+  users.json as they are consumed.
+
+  If stop (a threading.Event) is given and becomes set, this returns early,
+  leaving users.json as it was.
+  """
+  count = 0
+  with contextlib.closing(stream_to_json(users, 'users.json')) as written:
+    for user in written:
+      if stop is not None and stop.is_set():
+        print('Stopped before all users were saved.')
+        return
+      count += 1
+
+  print(f'Retrieved {count} users.')
 
 
-  return (topics, posts, users)
 
 
 
+@contextlib.contextmanager
+def open_for_replacement(filename):
+  """
+  Context manager opening a temporary file, next to the file with the given
+  name, for buffered binary writing. Only once the block completes is the
+  given file replaced with the temporary one; if the block raises (including
+  when a generator writing the file is closed early), the temporary file is
+  removed and the given file is left as it was. This way, an interrupted run
+  never leaves a truncated JSON file in place of the last good one.
+  """
+  temp_filename = filename + '.tmp'
 
+  # Opened outside the try: if this fails, there is no temporary file to
+  # remove, and the error is raised as is.
+  fobj = open(temp_filename, 'wb', buffering=OUTPUT_BUFFER_SIZE)
 
-def print_to_json(topics, posts, users):
-  # Now save the collected data as JSON.
-  # We have to adjust datetime objects to make them serializable.
-  with open('topics.json', 'w') as fobj:
-    json.dump(topics, fobj, default=serialize_datetime, indent=2)
+  try:
+    with fobj:
+      yield fobj
 
-  with open('posts.json', 'w') as fobj:
-    json.dump(posts, fobj, default=serialize_datetime, indent=2)
+  except BaseException:
+    os.remove(temp_filename)
+    raise
 
-  with open('users.json', 'w') as fobj:
-    json.dump(users, fobj, default=serialize_datetime, indent=2)
+  os.replace(temp_filename, filename)
 
 
 
 
 
-def generate_single_dict(topics, posts, users):
+def stream_to_json(rows, filename):
+  """
+  Generator yielding each of the given rows unchanged, while also writing
+  them to the given file as a JSON list. This allows rows streamed from the
+  database (see stream_topics()) to be saved as they are processed, without
+  holding all of them in memory at once.
   """
+  with open_for_replacement(filename) as fobj:
+    fobj.write(b'[')
+
+    first = True
+    for row in rows:
+      if not first:
+        fobj.write(b',')
+      first = False
+
+      fobj.write(orjson.dumps(row, default=serialize_for_json))
+
+      yield row
+
+    fobj.write(b']')
+
+
+
+
+
+def truncate_title(title):
+  """
+  Returns the given topic title, shortened to at most 39 characters, as it
+  appears in the header of each post in the topic.
+  """
+  if len(title) > 39: # 39 character max from topic title
+    return title[:36] + '...'
+  else:
+    return title
+
+
+
+
+
+def stream_dict_to_json(items, filename):
+  """
+  Generator yielding each of the given (key, value) 2-tuples unchanged, while
+  also writing them to the given file as a JSON object. This is to a
+  dictionary what stream_to_json() is to a list: e.g. the topics generated by
+  generate_topic_entries() can be saved as they are processed.
+  """
+  with open_for_replacement(filename) as fobj:
+    fobj.write(b'{')
+
+    first = True
+    for (key, value) in items:
+      if not first:
+        fobj.write(b',')
+      first = False
+
+      # JSON object keys are strings.
+      fobj.write(orjson.dumps(str(key)))
+      fobj.write(b':')
+      fobj.write(orjson.dumps(value, default=serialize_for_json))
+
+      yield (key, value)
+
+    fobj.write(b'}')
+
+
+
+
+
+def generate_single_dict(topics):
+  """
+  topics may be any iterable of topics (e.g. as streamed by stream_topics());
+  it is only iterated over once.
+
+  Topic dates are kept as datetime objects, and are only converted to strings
+  where they are written out (orjson serializes them itself). Post dates are
+  already ISO 8601 strings, formatted by Postgres.
+
   Example output:
   d = {
       1: {   # a topic ID and the associated topic
         'author': 'alice (Alice Bob (alice@bob.not)',
         'title': 'Look, a forum!',
-        'created': '2017-01-01T01:00:00.000000',
+        'title_trunc': 'Look, a forum!', # see truncate_title()
+        'created': datetime.datetime(2017, 1, 1, 1, 0),
         'posts': [
-            {'author': 'alice (Alice Bob alice@bob.not)',
-            'created': '2017-01-01T01:00:00.000000',
-            'updated': '2017-01-01T01:00:00.000000',
-            'image_url': None,
-            'raw': 'Lorem ipsum... \n'
+            Post(author='alice (Alice Bob alice@bob.not)',
+            created='2017-01-01T01:00:00.000000',
+            updated='2017-01-01T01:00:00.000000',
+            image_url=None,
+            raw='Lorem ipsum... \n'
+                '\n'
+                'dolor sit amet...',
+            cooked='<p>Lorem ipsum...</p>\n'
                    '\n'
-                   'dolor sit amet...',
-            'cooked': '<p>Lorem ipsum...</p>\n'
-                      '\n'
-                      '<p>dolor sit amet...</p>'},
-
-            {'author': 'clarice/Clarice Starling(clarice@unfortunate.not)',
-            'created': '2017-01-01T02:00:00.000000',
-            'updated': '2017-01-01T02:00:00.000000',
-            'image_url': None,
-            'raw': 'Donec ante dolor.',
-            'cooked': '<p>Donec ante dolor.</p>'},
+                   '<p>dolor sit amet...</p>'),
+
+            Post(author='clarice/Clarice Starling(clarice@unfortunate.not)',
+            created='2017-01-01T02:00:00.000000',
+            updated='2017-01-01T02:00:00.000000',
+            image_url=None,
+            raw='Donec ante dolor.',
+            cooked='<p>Donec ante dolor.</p>'),
 
             ... # more posts in the topic
         ]
@@ -195,51 +476,28 @@ def generate_single_dict(topics, posts, users):
       ... # more topics
   }
   """
-  d = {}
+  return dict(generate_topic_entries(topics))
 
-  usernames = {}
-  names = {}
-  emails = {}
 
-  for user in users:
-    uid = user[U_UID]
 
-    usernames[uid] = user[U_UNAME]
-    names[uid] = user[U_NAME]
-    emails[uid] = user[U_EMAIL]
 
 
+def generate_topic_entries(topics):
+  """
+  Generator yielding, for each of the given topics (e.g. as streamed by
+  stream_topics()), a 2-tuple containing the topic ID and the entry for the
+  topic in the dictionary generated by generate_single_dict(). This allows
+  topics to be processed (e.g. written out, see stream_dict_to_json()) one at
+  a time, without holding all of them in memory at once.
+  """
   for topic in topics:
-    tid = topic[T_TID]
-    uid = topic[T_UID]
-
-    d[tid] = {
-        'author': usernames[uid] + ' (' + names[uid] + ' ' + emails[uid] + ')',
-        'title': topic[T_TITLE],
-        'created': topic[T_CREATED].isoformat(),
-        'posts': []}
-
-
-  for post in posts:
-    tid = post[P_TID]
-    uid = post[P_UID]
-
-    if uid is not None:
-      author = usernames[uid] + ' (' + names[uid] + ' ' + emails[uid] + ')'
-    else:
-      author = 'UNKNOWN USER'
-
-    d[tid]['posts'].append({
-        'author': author,
-        'created': post[P_CREATED].isoformat(),
-        'updated': post[P_UPDATED].isoformat(),
-        'raw': post[P_RAW],
-        'cooked': post[P_COOKED],
-        'image_url': post[P_IMGURL]})
-
-
-  return d
-
+    # The posts of each topic arrive as dicts with the fields of Post.
+    yield (topic.id, {
+        'author': sys.intern(topic.author),
+        'title': topic.title,
+        'title_trunc': truncate_title(topic.title),
+        'created': topic.created_at,
+        'posts': [Post(**post) for post in topic.posts]})
 
 
 
@@ -258,50 +516,65 @@ def __OLD_construct_topic_digest(tid, d):
 
   topic = d[tid]
 
-  digest = 'This topic has been transfered from the Discourse forum to '
-  digest += 'this Google Group automatically.\nThe original post and all '
-  digest += 'replies are included. \n\n'
-  digest += 'Topic: ' + topic['title'] + '\n'
-  digest += 'Created By: ' + topic['author'] + '\n'
-  digest += 'Topic Date: ' + topic['created'] + '\n\n'
+  # The digests are assembled from parts joined at the end, rather than by
+  # repeatedly extending (and, for the HTML digest, re-converting) one string.
+  digest_parts = []
+  digest_cooked_parts = []
+
+  def emit(text, text_cooked=None):
+    # By default, the HTML form of a part is the plaintext with line breaks.
+    if text_cooked is None:
+      text_cooked = text.replace('\n', '<br />')
+    digest_parts.append(text)
+    digest_cooked_parts.append(text_cooked)
+
+  emit(
+      'This topic has been transfered from the Discourse forum to '
+      'this Google Group automatically.\nThe original post and all '
+      'replies are included. \n\n'
+      'Topic: ' + topic['title'] + '\n'
+      'Created By: ' + topic['author'] + '\n'
+      'Topic Date: ' + topic['created'].isoformat() + '\n\n')
 
   assert(len(topic['posts'])), 'Topic containing no posts??'
 
+  # The rest of each post header is the same for every post in the topic, but
+  # for the post number and details, so it is prepared (as plaintext and as
+  # HTML) only once.
+  banner = '-' * 78 + '\n--Post '
+  banner_cooked = banner.replace('\n', '<br />')
+  title_suffix = ' of Topic "' + topic['title_trunc'] + '"\n'
+  title_suffix_cooked = title_suffix.replace('\n', '<br />')
+
   for i in range(len(topic['posts'])):
 
     post = topic['posts'][i]
 
-    digest += '------------------------------------------------------------'
-    digest += '------------------\n'
-
-    digest += '--Post ' + str(i + 1) + ' of Topic "'
-
-    if len(topic['title']) > 39: # 39 character max from topic title
-      digest += topic['title'][:36] + '...'
+    if post.created != post.updated:
+      updated = 'Updated: ' + post.updated + '\n'
     else:
-      digest += topic['title']
-
-    digest += '"\n'
-
-    digest += 'Post Author: ' + post['author'] + '\n'
-    digest += 'Created: ' + post['created'] + '\n'
-
-    if post['created'] != post['updated']:
-      digest += 'Updated: ' + post['updated'] + '\n'
+      updated = ''
 
-    if post['image_url'] is not None:
-      digest += 'Attached Image URL: ' + post['image_url'] + '\n'
-
-    digest += '\n'
+    if post.image_url is not None:
+      image_url = 'Attached Image URL: ' + post.image_url + '\n'
+    else:
+      image_url = ''
 
+    number = str(i + 1)
 
-    digest_cooked = digest.replace('\n', '<br />')
+    emit(banner, banner_cooked)
+    emit(number, number)
+    emit(title_suffix, title_suffix_cooked)
+    emit(DIGEST_POST_DETAILS % {
+        'author': post.author,
+        'created': post.created,
+        'updated': updated,
+        'image_url': image_url})
+    emit(post.raw + '\n\n\n', post.cooked + '<br /><br /><br />')
 
-    digest += post['raw'] + '\n\n\n'
-    digest_cooked += post['cooked'] + '<br /><br /><br />'
 
+  return ''.join(digest_parts), ''.join(digest_cooked_parts)
 
-  return digest, digest_cooked
 
 
 
@@ -334,23 +607,49 @@ def __OLD_mail_in_topic_digest(d, tid):
   The gmailer module uses pre-configured authentication via oauth.
   """
 
-  if tid not in d:
-    raise Exception('Unknown tid ' + str(tid))
+  __OLD_mail_in_topic_digests(d, [tid])
 
-  elif 'digest_plain' not in d[tid] or 'digest_cooked' not in d[tid]:
-    raise Exception('No digest key for tid ' + str(tid))
 
-  elif not d[tid]['digest_plain'] or not d[tid]['digest_cooked']:
-    raise Exception('Empty digest for tid ' + str(tid))
 
-  print 'Sending in digests for topic ID ' + str(tid) + '...'
 
-  gmailer.SendMessage(
-      BACKUP_MAILER,
-      FORUM_ADDRESS,
-      d[tid]['title'],
-      d[tid]['digest_cooked'], # html (cooked)
-      d[tid]['digest_plain'])  # raw
+
+def __OLD_mail_in_topic_digests(d, tids=None):
+  """
+  OLD FUNCTION - entire topic as single post
+
+  Mails the digests of all (or select) topics. Rather than making one request
+  per topic, the digests are submitted to Gmail in batches (see
+  gmailer.batch_send()).
+
+  The gmailer module uses pre-configured authentication via oauth.
+  """
+
+  if tids is None:
+    tids = d.keys()
+
+  messages = []
+
+  for tid in tids:
+
+    if tid not in d:
+      raise Exception(f'Unknown tid {tid}')
+
+    elif 'digest_plain' not in d[tid] or 'digest_cooked' not in d[tid]:
+      raise Exception(f'No digest key for tid {tid}')
+
+    elif not d[tid]['digest_plain'] or not d[tid]['digest_cooked']:
+      raise Exception(f'Empty digest for tid {tid}')
+
+    messages.append(gmailer.build_message(
+        BACKUP_MAILER,
+        FORUM_ADDRESS,
+        d[tid]['title'],
+        d[tid]['digest_cooked'], # html (cooked)
+        d[tid]['digest_plain'])) # raw
+
+  print(f'Sending in digests for {len(messages)} topics...')
+
+  gmailer.batch_send(messages)
 
 
 
@@ -364,7 +663,7 @@ def mail_topic_as_posts(d, tid):
 
   # Send first post and save threadid.
 
-  print 'Mailing topic ' + str(tid) + ' as individual posts.'
+  print(f'Mailing topic {tid} as individual posts.')
 
   # Indicate that this is a new post.
   d[tid]['last_message_id'] = None
@@ -399,7 +698,9 @@ def mail_topics_as_posts_bf(d, tids=None):
   On the other hand, if we send the first message of every topic first, then
   the second message of every topic, then the third message of every topic,
   etc., then the only rate limitation we have is that required to not anger
-  Google for sending messages too quickly. 0.2s should suffice there.
+  Google for sending messages too quickly. Each round's messages are sent
+  together in batches (see gmailer.batch_send(), which backs off and retries
+  when rate limited), and the wait is only between rounds.
 
   """
 
@@ -415,35 +716,76 @@ def mail_topics_as_posts_bf(d, tids=None):
       most_posts_in_one_topic = len(d[tid]['posts'])
 
     if tid not in d:
-      raise Exception('Topic ID ' + str(tid) + ' is not known.')
+      raise Exception(f'Topic ID {tid} is not known.')
 
     d[tid]['thread_id'] = None
     d[tid]['last_message_id'] = None # probably not useful
 
 
   for post_number in range(0, most_posts_in_one_topic):
-    print('New round: preparing post #' + str(post_number) + ' in all topics.')
-    for tid in tids:
+    print(f'New round: preparing post #{post_number} in all topics.')
 
-      if post_number >= len(d[tid]['posts']):
-        continue
+    # All of this round's posts are sent together, in batches (see
+    # gmailer.batch_send()). Each is in a different topic, so their relative
+    # order does not matter. The messages are only built as their batch is
+    # sent, so that a round's messages (and attachments) are never all in
+    # memory at once.
+    round_tids = [tid for tid in tids if post_number < len(d[tid]['posts'])]
 
-      mail_one_post(d, tid, post_number)
+    print(f'Mailing post {post_number} in {len(round_tids)} topics.')
+    results = gmailer.batch_send(
+        round_tids, lambda tid: build_post_message(d, tid, post_number))
 
-      time.sleep(SLEEP_DURATION_BETWEEN_MAILINGS)
+    failed_tids = []
+
+    for (tid, result) in zip(round_tids, results):
+
+      if not isinstance(result, dict) or 'labelIds' not in result or \
+          'SENT' not in result['labelIds']:
+        failed_tids.append(tid)
+        continue
 
       # Save thread ID so we can send the next post in the same topic to the
       # same thread.
       d[tid]['thread_id'] = result['threadId']
       d[tid]['last_message_id'] = result['id'] # not currently used, but could avoid races? -- no. The reply-to reference should be set using information received by the recipient, I think.... Or, actually, by the mail server. We don't have that info.
 
-    print 'Waiting between rounds to help prevent out-of-order posts....'
+    # Stop if any message failed to send, once the thread IDs of those that
+    # were sent have been recorded.
+    if failed_tids:
+      raise Exception(
+          f'Unable to send post {post_number} in topics {failed_tids}')
+
+    print('Waiting between rounds to help prevent out-of-order posts....')
     time.sleep(SLEEP_DURATION_BETWEEN_TOPIC_ROUNDS)
 
 
 
 
 
+def build_post_message(d, tid, post_number):
+  """
+  Returns the Gmail API message body (see gmailer.build_message()) for the
+  given post, to be sent in to the forum in the topic's thread, if a message
+  in that topic has already been sent (see mail_topics_as_posts_bf()).
+  """
+  (text, text_html) = construct_post_email_contents(d, tid, post_number)
+
+  image_url = process_image_url(d, tid, post_number)
+
+  return gmailer.build_message(
+      BACKUP_MAILER,
+      FORUM_ADDRESS,
+      d[tid]['title'],
+      text_html,
+      text,
+      image_url,  # attachment
+      d[tid]['thread_id'])
+
+
+
+
+
 def mail_one_post(d, tid, post_number, thread_id=None, last_message_id=None):
 
   (text, text_html) = construct_post_email_contents(d, tid, post_number)
@@ -456,7 +798,7 @@ def mail_one_post(d, tid, post_number, thread_id=None, last_message_id=None):
   if last_message_id is None:
     last_message_id = d[tid]['last_message_id']
 
-  print 'Mailing post ' + str(post_number) + ' in topic ' + str(tid)
+  print(f'Mailing post {post_number} in topic {tid}')
   result = gmailer.SendMessage(
     BACKUP_MAILER,
     FORUM_ADDRESS,
@@ -475,10 +817,10 @@ def mail_one_post(d, tid, post_number, thread_id=None, last_message_id=None):
   # Stop if a message fails to send.
   if not isinstance(result, dict) or 'labelIds' not in result or \
       'SENT' not in result['labelIds']:
-    raise Exception('Unable to send post ' + str(post_number) +
-        ' in topic ' + str(tid) + '; previous message id was: ' +
-        repr(previous_message_id_by_tid[tid]) + '; thread ID: ' +
-        repr(d[tid]['thread_id']))
+    raise Exception(
+        f'Unable to send post {post_number} in topic {tid}; '
+        f'previous message id was: {last_message_id!r}; '
+        f'thread ID: {d[tid]["thread_id"]!r}')
 
   d[tid]['thread_id'] = result['threadId']
   d[tid]['last_message_id'] = result['id']
@@ -497,50 +839,73 @@ def construct_post_email_contents(d, tid, post_number):
   """
 
   if tid not in d:
-    raise Exception('Topic ' + str(tid) + ' is not known.')
+    raise Exception(f'Topic {tid} is not known.')
 
   elif 'posts' not in d[tid]:
-    raise Exception('Topic entry ' + str(tid) + ' lacks expected structure.')
+    raise Exception(f'Topic entry {tid} lacks expected structure.')
 
   elif len(d[tid]['posts']) < post_number:
-    raise Exception('Topic ' + str(tid) + ' does not have a ' +
-        str(post_number) + 'th reply.')
+    raise Exception(f'Topic {tid} does not have a {post_number}th reply.')
 
-  topic_title = d[tid]['title']
   post = d[tid]['posts'][post_number]
 
 
-  text = ''
-
-  if post_number == 0:
-    text += 'Topic posted by Discourse-to-Google-Groups forum transfer.\n'
+  (text_template, html_template) = make_topic_header_templates(
+      d[tid]['title_trunc'])
 
-  text += 'Post ' + str(post_number + 1) + ' of Topic "'
+  if post.created != post.updated:
+    updated = 'Post Updated: ' + post.updated + '\n'
+  else:
+    updated = ''
 
-  if len(topic_title) > 39: # 39 character max from topic title
-    text += topic_title[:36] + '...'
+  if post.image_url is not None:
+    image_url = 'Attached Image URL: ' + post.image_url + '\n'
   else:
-    text += topic_title
+    image_url = ''
 
-  text += '"\n'
+  details = {
+      'post_number': post_number + 1,
+      'created': post.created,
+      'updated': updated,
+      'image_url': image_url,
+      'author': post.author}
 
-  text += 'Post Created: ' + post['created'] + '\n'
+  # Line breaks in the details are converted for the HTML header as well;
+  # those in the template already have been.
+  details_html = dict(details)
+  details_html['updated'] = updated.replace('\n', '<br />')
+  details_html['image_url'] = image_url.replace('\n', '<br />')
 
-  if post['created'] != post['updated']:
-    text += 'Post Updated: ' + post['updated'] + '\n'
+  text = text_template % details + post.raw + '\n\n\n'
+  text_html = html_template % details_html + post.cooked + \
+      '<br /><br /><br />'
 
-  if post['image_url'] is not None:
-    text += 'Attached Image URL: ' + post['image_url'] + '\n'
+  if post_number == 0:
+    text = FIRST_POST_BANNER + text
+    text_html = FIRST_POST_BANNER_HTML + text_html
 
-  text += 'Post Author ' + post['author'] + ' wrote:\n\n'
 
-  text_html = text.replace('\n', '<br />')
+  return text, text_html
 
-  text += post['raw'] + '\n\n\n'
-  text_html += post['cooked'] + '<br /><br /><br />'
 
 
-  return text, text_html
+
+
+
+@functools.lru_cache(maxsize=None)
+def make_topic_header_templates(title_trunc):
+  """
+  Returns a 2-tuple containing the plaintext and HTML templates for the
+  header of each post email in the topic with the given truncated title (see
+  truncate_title() and POST_EMAIL_HEADER). The title is only filled in, and
+  the line breaks only converted for HTML, once per topic, rather than once
+  per post.
+  """
+  # '%' in the title must survive as itself when the per-post details are
+  # filled in.
+  text_template = POST_EMAIL_HEADER % {'title': title_trunc.replace('%', '%%')}
+
+  return text_template, text_template.replace('\n', '<br />')
 
 
 
@@ -556,16 +921,36 @@ def process_image_url(d, tid, post_number):
   available locally in the filesystem. Else returns None.
   """
 
-  image_url = d[tid]['posts'][post_number]['image_url']
+  image_url = d[tid]['posts'][post_number].image_url
 
   if image_url is None:
     return None
 
-  elif image_url.startswith('http://') or image_url.startswith('https://'):
-    print 'Skipping attachment that was added as an http(s) link, ' \
-        'topic ' + str(tid) + ', post #' + str(post_number) + '; ' \
-        'url: ' + image_url
-    return None
+  (local_path, reason) = resolve_image_url(image_url)
+
+  if local_path is None:
+    print(f'Skipping attachment that {reason}, '
+        f'topic {tid}, post #{post_number}; url: {image_url}')
+
+  return local_path
+
+
+
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_image_url(image_url):
+  """
+  Given the (non-None) image_url of a post, returns a 2-tuple containing:
+   - the local path of the attachment, or None if it is not available locally
+   - if it is not, the reason why, else None
+
+  Results are cached, so the filesystem is checked only once per URL,
+  however many posts share the attachment or however often it is sent.
+  """
+
+  if image_url.startswith('http://') or image_url.startswith('https://'):
+    return (None, 'was added as an http(s) link')
 
   elif image_url.startswith(INTERNAL_UPLOAD_PATH_PREFIX):
     # Cut out path prefix for uploads directory if it's there and replace
@@ -573,14 +958,36 @@ def process_image_url(d, tid, post_number):
     image_url = PATH_TO_UPLOADS_DIR + image_url[len(
         INTERNAL_UPLOAD_PATH_PREFIX):]
 
-  if not os.path.exists(image_url):
-    print 'Skipping attachment that cannot be found locally. ' \
-        'topic ' + str(tid) + ', post #' + str(post_number) + '; ' \
-        'url: ' + image_url
-    return None
+    # Uploads are looked up in the listing of the uploads directory rather
+    # than checked for one by one.
+    found = os.path.normpath(image_url) in list_local_uploads()
+
+  else:
+    found = os.path.exists(image_url)
+
+  if not found:
+    return (None, 'cannot be found locally')
 
   else:
-    return image_url
+    return (image_url, None)
+
+
+
+
+
+@functools.lru_cache(maxsize=None)
+def list_local_uploads():
+  """
+  Returns a frozenset of the (normalized) paths of all files in the local
+  copy of the uploads directory, PATH_TO_UPLOADS_DIR. The directory is only
+  walked once, the first time this is called. Symlinked subdirectories are
+  followed, as os.path.exists() would follow them.
+  """
+  return frozenset(
+      os.path.normpath(os.path.join(root, filename))
+      for (root, dirs, filenames)
+      in os.walk(PATH_TO_UPLOADS_DIR, followlinks=True)
+      for filename in filenames)
 
 
 
@@ -596,7 +1003,7 @@ def find_in_posts(text, d, tid=None):
 
   for tid in search_set:
     for post_number in range(0, len(d[tid]['posts'])):
-      if text in d[tid]['posts'][post_number]['raw']:
+      if text in d[tid]['posts'][post_number].raw:
         posts.append((tid, post_number))
 
   return posts
@@ -606,7 +1013,26 @@ def find_in_posts(text, d, tid=None):
 
 
 def get_post_text(d, tid, post_number):
-  return d[tid]['posts'][post_number]['raw']
+  return d[tid]['posts'][post_number].raw
+
+
+
+
+
+def topic_argument(value):
+  """
+  Given the topic command-line argument, returns 'all' if that is what it is,
+  or else the topic ID it gives, as an int. Raises
+  argparse.ArgumentTypeError if it is neither, so that argparse reports it.
+  """
+  if value == 'all':
+    return value
+
+  try:
+    return int(value)
+  except ValueError:
+    raise argparse.ArgumentTypeError(
+        f"expected a topic ID or 'all', not {value!r}")
 
 
 
@@ -617,27 +1043,84 @@ def main():
   See top of module for docstring.
   """
 
-  (topics, posts, users) = harvest_from_psql_db()
+  parser = argparse.ArgumentParser(
+      description='Harvest a Discourse forum and mail it in to a Google Group.')
+  parser.add_argument(
+      'tid', nargs='?', type=topic_argument,
+      help="ID of the topic to mail in, or 'all' to mail in all topics")
+  parser.add_argument(
+      '--dump', action='store_true',
+      help='save the harvested data as JSON files even when mailing topics')
+  args = parser.parse_args()
+
+  # Without a topic to mail, saving the JSON files is all there is to do.
+  dump = args.dump or args.tid is None
+
+  if args.tid is None or args.tid == 'all':
+    tid_to_email = None
+  else:
+    tid_to_email = args.tid
+
+  # When mailing a single topic, only that topic is harvested, unless the
+  # JSON files are to be saved: they always hold the whole forum.
+  (topics, users) = harvest_from_psql_db(
+      None if dump else tid_to_email, include_users=dump)
 
-  print_to_json(topics, posts, users)
+  # The users are harvested and written to users.json in the background,
+  # over their own database connection, while the topics are harvested. If
+  # harvesting the topics fails, stop_users is set so that the users are not
+  # saved either, and the run ends (after the users' worker has stopped).
+  stop_users = threading.Event()
 
-  d = generate_single_dict(topics, posts, users)
+  with ThreadPoolExecutor(max_workers=1) as users_executor:
 
-  # __OLD_add_all_topic_digests(d)
+    if dump:
+      users_written = users_executor.submit(print_to_json, users, stop_users)
+
+      # The topics (with their posts) are written to topics.json as they are
+      # streamed in.
+      topics = stream_to_json(topics, 'topics.json')
+
+    entries = generate_topic_entries(topics)
+
+    if dump:
+      # The processed topics are likewise written to processed_post_data.json
+      # one at a time.
+      entries = stream_dict_to_json(entries, 'processed_post_data.json')
 
-  with open('processed_post_data.json', 'w') as fobj:
-    json.dump(d, fobj, indent=2)
+    # The processed topics are only kept in memory if they are to be mailed.
+    d = {}
+    topic_count = 0
+    post_count = 0
+
+    try:
+      for (tid, topic) in entries:
+        topic_count += 1
+        post_count += len(topic['posts'])
+        if args.tid == 'all' or tid == tid_to_email:
+          d[tid] = topic
+
+    except BaseException:
+      stop_users.set()
+      raise
+
+    if dump:
+      # Raises any exception that occurred while writing users.json.
+      users_written.result()
+
+  print(f'Retrieved {topic_count} topics containing {post_count} posts.')
+
+  # __OLD_add_all_topic_digests(d)
 
 
-  if len(sys.argv) == 2 and sys.argv[1] == 'all':
+  if args.tid == 'all':
     mail_topics_as_posts_bf(d)
     return
 
-  elif len(sys.argv) == 2:
-    tid_to_email = int(sys.argv[1])
+  elif tid_to_email is not None:
 
     if tid_to_email not in d:
-      raise Exception('Unknown topic ID ' + str(tid))
+      raise Exception(f'Unknown topic ID {tid_to_email}')
 
     else: # redundant control (if clause raised exception)
       mail_topic_as_posts(d, tid_to_email)